@@ -1,8 +1,19 @@
+import time
+import warnings
+from typing import Dict
+
+import torch
 from torch import nn
 from torch.utils.data import DataLoader
 from pytorchltr.evaluation.dcg import ndcg
 from pytorchltr.datasets.svmrank.svmrank import SVMRankDataset
 
+from model import (
+    MLPScoreFunc,
+    check_export_score_func,
+    export_score_func,
+    freeze_score_func,
+)
 from utils import convert_rel_to_gamma
 
 
@@ -18,3 +29,109 @@ def evaluate_test_performance(score_fn: nn.Module, test: SVMRankDataset) -> floa
             score_fn(batch.features), gamma, batch.n, k=10, exp=False
         ).sum()
     return float(ndcg_score / len(test))
+
+
+def _measure_throughput(
+    score_fn: nn.Module, test: SVMRankDataset, n_repeats: int = 5
+) -> float:
+    """テストデータ全体をスコアリングする際のスループット（ドキュメント数/秒）を計測する.
+
+    バッチごとに一度だけ計測対象外のスコアリングを行い（ウォームアップ）、n_repeats回の計測のうち最も短い時間を用いる.
+    バッチの作成にかかる時間は計測に含めない.
+
+    """
+    loader = DataLoader(
+        test, batch_size=1024, shuffle=False, collate_fn=test.collate_fn()
+    )
+    num_docs, elapsed = 0, 0.0
+    with torch.no_grad():
+        for batch in loader:
+            score_fn(batch.features)
+            elapsed_list = list()
+            for _ in range(n_repeats):
+                start = time.perf_counter()
+                score_fn(batch.features)
+                elapsed_list.append(time.perf_counter() - start)
+            num_docs += int(batch.n.sum())
+            elapsed += min(elapsed_list)
+    return num_docs / elapsed
+
+
+def _weight_memory_mb(score_fn: nn.Module) -> float:
+    """スコアリング関数のパラメータ（量子化済みの重みを含む）が占めるメモリ量（MB）を計算する."""
+    nbytes = 0
+    for value in score_fn.state_dict().values():
+        tensors = value if isinstance(value, tuple) else (value,)
+        for tensor in tensors:
+            if isinstance(tensor, torch.Tensor):
+                nbytes += tensor.element_size() * tensor.nelement()
+    return nbytes / 1e6
+
+
+def compare_inference_performance(
+    score_fn: MLPScoreFunc,
+    test: SVMRankDataset,
+    precision: str = "int8",
+    use_jit: bool = False,
+    ndcg_tolerance: float = 0.01,
+) -> Dict[str, float]:
+    """fp32のスコアリング関数と推論向けに変換したスコアリング関数の性能を比較する.
+
+    比較の前に`model.check_export_score_func`によって変換後のスコアリング関数が正しく動作するかを確認する.
+
+    パラメータ
+    ----------
+    score_fn: MLPScoreFunc
+        学習済みのスコアリング関数.
+
+    test: SVMRankDataset
+        （オリジナルの）テストデータ.
+
+    precision: str, default='int8'
+        推論時の数値精度. `model.export_score_func`を参照.
+
+    use_jit: bool, default=False
+        TorchScriptを用いるか否か. `model.export_score_func`を参照.
+
+    ndcg_tolerance: float, default=0.01
+        許容するnDCG@10の低下幅. これを超えてnDCG@10が低下した場合や、スループットが低下した場合は警告を出す.
+
+    """
+    check_export_score_func(score_fn)
+    training = score_fn.training
+    score_fn.eval()
+    try:
+        # メモリ量はTorchScriptに変換する前のモデルで計算する（変換によって重みの保持形式は変わらない）
+        exported = export_score_func(score_fn, precision=precision)
+        memory_fp32 = _weight_memory_mb(score_fn)
+        memory_exported = _weight_memory_mb(exported)
+        if use_jit:
+            exported = freeze_score_func(exported, input_size=score_fn.input_size)
+        with torch.no_grad():
+            ndcg_fp32 = evaluate_test_performance(score_fn=score_fn, test=test)
+            ndcg_exported = evaluate_test_performance(score_fn=exported, test=test)
+        throughput_fp32 = _measure_throughput(score_fn=score_fn, test=test)
+        throughput_exported = _measure_throughput(score_fn=exported, test=test)
+    finally:
+        score_fn.train(training)
+
+    result = dict(
+        ndcg_fp32=ndcg_fp32,
+        ndcg_exported=ndcg_exported,
+        ndcg_diff=ndcg_exported - ndcg_fp32,
+        throughput_fp32=throughput_fp32,
+        throughput_exported=throughput_exported,
+        speedup=throughput_exported / throughput_fp32,
+        weight_memory_mb_fp32=memory_fp32,
+        weight_memory_mb_exported=memory_exported,
+        weight_memory_reduction=1.0 - memory_exported / memory_fp32,
+    )
+    setting = f"precision={precision}, use_jit={use_jit}"
+    if result["ndcg_diff"] < -ndcg_tolerance:
+        warnings.warn(
+            f"nDCG@10 dropped by {-result['ndcg_diff']:.4f} ({setting}), "
+            f"which exceeds ndcg_tolerance={ndcg_tolerance}"
+        )
+    if result["speedup"] < 1.0:
+        warnings.warn(f"throughput decreased by exporting the model ({setting})")
+    return result
@@ -1,6 +1,8 @@
+from copy import deepcopy
 from dataclasses import dataclass
 from typing import Tuple
 
+import torch
 from torch import nn, FloatTensor
 
 
@@ -41,3 +43,143 @@ class MLPScoreFunc(nn.Module):
         for layer in self.hidden_layers:
             h = self.activation_func(layer(h))
         return self.output(h).flatten(1)  # f_{\phi}, (batch_size, number_of_documents)
+
+
+class _BFloat16ScoreFunc(nn.Module):
+    """bf16で推論を行うスコアリング関数. 入出力はfp32のまま扱えるようにキャストする."""
+
+    def __init__(self, score_fn: nn.Module) -> None:
+        super().__init__()
+        self.score_fn = score_fn.to(torch.bfloat16)
+
+    def forward(self, x: FloatTensor) -> FloatTensor:
+        return self.score_fn(x.to(torch.bfloat16)).float()
+
+
+def is_bf16_supported(score_fn: MLPScoreFunc) -> bool:
+    """インストールされているPyTorchがCPU上でscore_fnをbf16で計算できるかを確認する.
+
+    例えば、torch==1.9.0ではeluがbf16に対応していないため、Falseが返る.
+
+    """
+    x = torch.zeros(1, 1, score_fn.input_size, dtype=torch.bfloat16)
+    weight = torch.zeros(1, score_fn.input_size, dtype=torch.bfloat16)
+    bias = torch.zeros(1, dtype=torch.bfloat16)
+    try:
+        with torch.no_grad():
+            score_fn.activation_func(nn.functional.linear(x, weight, bias))
+    except RuntimeError:
+        return False
+    return True
+
+
+def freeze_score_func(score_fn: nn.Module, input_size: int) -> nn.Module:
+    """スコアリング関数をTorchScriptでトレースしたうえで計算グラフを凍結（演算を融合）する."""
+    with torch.no_grad():
+        example = torch.zeros(1, 1, input_size)
+        return torch.jit.freeze(torch.jit.trace(score_fn.eval(), example))
+
+
+def export_score_func(
+    score_fn: MLPScoreFunc,
+    precision: str = "int8",
+    use_jit: bool = False,
+) -> nn.Module:
+    """学習済みのスコアリング関数をCPU推論向けに変換する.
+
+    パラメータ
+    ----------
+    score_fn: MLPScoreFunc
+        学習済みのスコアリング関数. 元のモデルは変更されない.
+
+    precision: str, default='int8'
+        推論時の数値精度. 'fp32', 'int8', 'bf16'のいずれかしか与えることができない.
+        'int8'が与えられた場合は、nn.Linearの重みを動的量子化する.
+        'bf16'は、インストールされているPyTorchが対応している場合にのみ与えることができる（`is_bf16_supported`を参照）.
+
+    use_jit: bool, default=False
+        Trueの場合は、`freeze_score_func`によってTorchScriptに変換する.
+
+    """
+    assert precision in [
+        "fp32",
+        "int8",
+        "bf16",
+    ], f"precision must be 'fp32', 'int8', or 'bf16', but {precision} is given"
+    if precision == "bf16":
+        assert is_bf16_supported(
+            score_fn
+        ), f"precision='bf16' is not supported on CPU by torch {torch.__version__}"
+    exported = deepcopy(score_fn).eval()
+    if precision == "int8":
+        exported = torch.quantization.quantize_dynamic(
+            exported, {nn.Linear}, dtype=torch.qint8
+        )
+    elif precision == "bf16":
+        exported = _BFloat16ScoreFunc(exported).eval()
+    if use_jit:
+        exported = freeze_score_func(exported, input_size=score_fn.input_size)
+    return exported
+
+
+def _rank_correlation(scores: FloatTensor, expected: FloatTensor) -> FloatTensor:
+    """クエリごとに2つのスコアが与える順位の相関（スピアマンの順位相関係数）を計算する."""
+    ranks = scores.argsort(dim=1).argsort(dim=1).float()
+    ranks -= ranks.mean(dim=1, keepdim=True)
+    expected_ranks = expected.argsort(dim=1).argsort(dim=1).float()
+    expected_ranks -= expected_ranks.mean(dim=1, keepdim=True)
+    return (ranks * expected_ranks).sum(dim=1) / (
+        ranks.norm(dim=1) * expected_ranks.norm(dim=1)
+    )
+
+
+def check_export_score_func(
+    score_fn: MLPScoreFunc,
+    batch_size: int = 8,
+    num_docs: int = 16,
+    min_rank_corr: float = 0.95,
+    random_state: int = 12345,
+) -> None:
+    """全てのprecisionとuse_jitの組み合わせについて、変換後のスコアリング関数が正しく動作するかを確認する.
+
+    ランダムな特徴量ベクトルに対して、出力の形状が(batch_size, num_docs)であること、データ型がfp32であること、
+    fp32のスコアリング関数の出力と比べたクエリごとの順位相関の平均がmin_rank_corr以上であることを確かめる.
+    fp32とbf16については、出力の値が許容誤差の範囲で一致することも確かめる.
+    bf16に対応していないPyTorchの場合は、bf16の確認を行わない.
+
+    """
+    tolerances = {"fp32": 1e-5, "int8": None, "bf16": 2e-2}
+    if not is_bf16_supported(score_fn):
+        del tolerances["bf16"]
+    generator = torch.Generator().manual_seed(random_state)
+    x = torch.randn(batch_size, num_docs, score_fn.input_size, generator=generator)
+    training = score_fn.training
+    score_fn.eval()
+    try:
+        with torch.no_grad():
+            expected = score_fn(x)
+            for precision, tol in tolerances.items():
+                for use_jit in [False, True]:
+                    exported = export_score_func(
+                        score_fn, precision=precision, use_jit=use_jit
+                    )
+                    scores = exported(x)
+                    setting = f"precision={precision}, use_jit={use_jit}"
+                    assert scores.shape == (
+                        batch_size,
+                        num_docs,
+                    ), f"unexpected output shape {tuple(scores.shape)} ({setting})"
+                    assert (
+                        scores.dtype == torch.float32
+                    ), f"unexpected output dtype {scores.dtype} ({setting})"
+                    rank_corr = float(_rank_correlation(scores, expected).mean())
+                    assert (
+                        rank_corr >= min_rank_corr
+                    ), f"rank correlation with the fp32 scoring function is {rank_corr:.4f} ({setting})"
+                    if tol is not None:
+                        atol = tol * float(expected.abs().max())
+                        assert torch.allclose(
+                            scores, expected, rtol=tol, atol=atol
+                        ), f"output differs from the fp32 scoring function ({setting})"
+    finally:
+        score_fn.train(training)